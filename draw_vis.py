@@ -2,13 +2,21 @@
 """
 import os
 import csv
+import struct
 import glob
 import json
+import argparse
+import hashlib
+import shutil
+import subprocess
+import sys
 import textwrap
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from functools import cached_property
 from itertools import cycle
 from math import asin, cos, pi, sin, sqrt
 
+import numpy as np
 from lxml import etree as ET
 
 # Inner radius for per country display
@@ -72,7 +80,7 @@ def circle_part(radius=0, phi_start=0, phi_end=pi/2):
                 M{start_x} {start_y}
                 A{radius} {radius} 0 {large} {counterclock} {end_x} {end_y}
               """).replace("\n", ""),
-        "stroke": STROKE_COLOR,
+        "class": "outline",
         "stroke-width": f"{STROKES}",
         "fill": "none",
     })
@@ -89,7 +97,7 @@ def seperator(radius_inner, radius_outer, phi):
                 M{start_inner_x} {start_inner_y}
                 L{start_outer_x} {start_outer_y}
               """).replace("\n", ""),
-        "stroke": STROKE_COLOR,
+        "class": "outline",
         "stroke-width": f"{STROKES}",
         "fill": "none",
     })
@@ -171,6 +179,10 @@ class Datapoint():
     def hash(self):
         raise NotImplementedError()
     @property
+    def key(self):
+        """identifier that is stable across runs, unlike hash"""
+        raise NotImplementedError()
+    @property
     def label(self):
         raise NotImplementedError()
     @property
@@ -196,11 +208,15 @@ class Country(Datapoint):
     def hash(self):
         return hash(self._pop_data["iso_code"])
 
+    @property
+    def key(self):
+        return self._pop_data["iso_code"]
+
     @property
     def size(self):
         return self._pop_data["population"]
 
-    @property
+    @cached_property
     def model_count(self):
         return model_people_vacc(self._vacc_data)
 
@@ -216,7 +232,7 @@ class Country(Datapoint):
         return []
 
 class CountryPartial(Country):
-    @property
+    @cached_property
     def model_count(self):
         return model_people_vacc_partial(self._vacc_data)
 
@@ -232,11 +248,15 @@ class USState(Datapoint):
     def hash(self):
         return self._sdata["ShortName"]
 
+    @property
+    def key(self):
+        return self._sdata["ShortName"]
+
     @property
     def size(self):
         return int(float(self._sdata["Census2019"]))
 
-    @property
+    @cached_property
     def model_count(self):
         return model_people_vacc_state(self._sdata)
 
@@ -250,14 +270,16 @@ class USState(Datapoint):
         return []
 
 class USStatePartial(USState):
-    @property
+    @cached_property
     def model_count(self):
         return model_people_vacc_state_partial(self._sdata)
 
 class Region(Datapoint):
-    def __init__(self, region, subregions):
+    def __init__(self, region, subregions, totals=None):
         self._region = region
         self._subregions = subregions
+        # precomputed GroupTotal, see Aggregation
+        self._totals = totals
 
     @property
     def label(self):
@@ -267,12 +289,20 @@ class Region(Datapoint):
     def hash(self):
         return hash(self._region)
 
+    @property
+    def key(self):
+        return self._region
+
     @property
     def size(self):
+        if self._totals is not None:
+            return self._totals.size
         return sum(s.size for s in self._subregions)
 
     @property
     def fraction_filled(self):
+        if self._totals is not None:
+            return self._totals.fraction_filled
         if all(s.fraction_filled is None for s in self._subregions):
             return None
         people_vacced = sum(
@@ -297,6 +327,11 @@ class FakeClass(Datapoint):
             reverse=True,
         )
 
+    @property
+    def standins(self):
+        """the bunched datapoints"""
+        return self._standins
+
     @property
     def label(self):
         if not self._standins:
@@ -312,6 +347,11 @@ class FakeClass(Datapoint):
     def hash(self):
         return hash(tuple(s.hash for s in self._standins))
 
+    @property
+    def key(self):
+        members = ",".join(s.key for s in self._standins)
+        return "etc-" + hashlib.sha1(members.encode("utf-8")).hexdigest()[:12]
+
     @property
     def size(self):
         return sum(s.size for s in self._standins)
@@ -338,10 +378,137 @@ class FakeClass(Datapoint):
                     yield c
         return list(children_it())
 
+GroupTotal = namedtuple("GroupTotal", ["size", "fraction_filled"])
+
+class Grouping():
+    """
+    Assignment of aggregation rows to labeled groups. A row
+    can be a member of any number of groups.
+    """
+    def __init__(self):
+        self.labels = {}
+        self.members = []
+        self.codes = []
+
+    def add(self, label, member):
+        code = self.labels.setdefault(label, len(self.labels))
+        self.members.append(member)
+        self.codes.append(code)
+
+class Aggregation():
+    """
+    Population and vaccinated counts of several datapoints, for all
+    models at once. Counts have shape (models, rows), nan marks a row
+    without data for that model.
+
+    Aggregates the same way as Region and FakeClass: rows without data
+    don't count towards a group's percentage, and the fraction of a group
+    is extrapolated to its whole size when it is aggregated further.
+    """
+    def __init__(self, population, counts, labels=None):
+        self._population = np.asarray(population, dtype=float)
+        self._counts = np.asarray(counts, dtype=float)
+        self._labels = labels or {}
+
+    def __len__(self):
+        return len(self._population)
+
+    def concat(self, other):
+        """rows of other are appended, offset by len(self)"""
+        labels = dict(self._labels)
+        labels.update((l, len(self) + r) for l, r in other._labels.items())
+        return Aggregation(
+            np.concatenate((self._population, other._population)),
+            np.concatenate((self._counts, other._counts), axis=1),
+            labels,
+        )
+
+    def reduce(self, grouping):
+        """
+        Total every group of the grouping in one grouped reduction.
+        Returns an Aggregation with one row per group.
+        """
+        group_count = len(grouping.labels)
+        model_count = self._counts.shape[0]
+        members = np.asarray(grouping.members, dtype=np.intp)
+        codes = np.asarray(grouping.codes, dtype=np.intp)
+
+        population = self._population[members]
+        counts = self._counts[:, members]
+        has_data = ~np.isnan(counts)
+        # offset the codes per model to reduce all models with one bincount
+        model_codes = (codes + group_count * np.arange(model_count)[:, None]).ravel()
+        def grouped_sum(weights):
+            return np.bincount(
+                model_codes, weights=weights.ravel(), minlength=model_count * group_count
+            ).reshape(model_count, group_count)
+
+        size = np.bincount(codes, weights=population, minlength=group_count)
+        vacced = grouped_sum(np.where(has_data, counts, 0))
+        size_with_data = grouped_sum(has_data * population)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(size_with_data > 0, vacced / size_with_data, np.nan)
+        return Aggregation(size, fraction * size, grouping.labels)
+
+    def total(self, model_index, label):
+        row = self._labels[label]
+        size = int(self._population[row])
+        count = self._counts[model_index, row]
+        if np.isnan(count):
+            return GroupTotal(size, None)
+        return GroupTotal(size, float(count / size))
+
 # https://gist.github.com/xgfs/37436865b6616eebd09146007fea6c09
-PALETTE_XGFS_NORMAL12 = cycle(
-    [(235, 172, 35), (184, 0, 88), (0, 140, 249), (0, 110, 0), (0, 187, 173), (209, 99, 230), (178, 69, 2), (255, 146, 135), (89, 84, 214), (0, 198, 248), (135, 133, 0), (0, 167, 108), (189, 189, 189)]
-)
+PALETTE_XGFS_NORMAL12 = [(235, 172, 35), (184, 0, 88), (0, 140, 249), (0, 110, 0), (0, 187, 173), (209, 99, 230), (178, 69, 2), (255, 146, 135), (89, 84, 214), (0, 198, 248), (135, 133, 0), (0, 167, 108), (189, 189, 189)]
+# https://jfly.uni-koeln.de/color/
+PALETTE_OKABE_ITO = [(230, 159, 0), (86, 180, 233), (0, 158, 115), (240, 228, 66), (0, 114, 178), (213, 94, 0), (204, 121, 167), (153, 153, 153)]
+# number of palette classes segments cycle through
+PALETTE_SIZE = len(PALETTE_XGFS_NORMAL12)
+
+def hex_color(color):
+    r, g, b = color
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+class Theme():
+    """
+    Colors of a diagram. Segments only carry classes, so a rendered
+    diagram can be written in every theme by swapping the theme's style.
+    """
+    def __init__(self, name, palette, total, outline, hatch, text):
+        self.name = name
+        self.palette = palette
+        self.total = total
+        self.outline = outline
+        self.hatch = hatch
+        self.text = text
+
+    def css(self):
+        rules = [
+            f"text {{ fill: {self.text}; }}",
+            f".total {{ fill: {self.total}; }}",
+            f".outline {{ stroke: {self.outline}; }}",
+            f".hatch {{ stroke: {self.hatch}; }}",
+        ]
+        rules.extend(
+            f".palette-{i} {{ fill: {hex_color(self.palette[i % len(self.palette)])}; }}"
+            for i in range(PALETTE_SIZE)
+        )
+        return "\n".join(rules)
+
+    def filename(self, filename):
+        """filename of a result in this theme"""
+        if self.name == DEFAULT_THEME:
+            return filename
+        (root, ext) = os.path.splitext(filename)
+        return f"{root}_{self.name}{ext}"
+
+DEFAULT_THEME = "default"
+
+THEMES = {t.name: t for t in [
+    Theme(DEFAULT_THEME, PALETTE_XGFS_NORMAL12, "#279ee3", STROKE_COLOR, "#444", "#000"),
+    Theme("dark", PALETTE_XGFS_NORMAL12, "#279ee3", "#666", "#bbb", "#eee"),
+    Theme("colorblind", PALETTE_OKABE_ITO, "#0072b2", STROKE_COLOR, "#444", "#000"),
+]}
 
 def bunch_datapoints(datapoints, inner_radius, radian_size):
     """
@@ -395,55 +562,112 @@ def bunch_datapoints(datapoints, inner_radius, radian_size):
     actual_fakes = FakeClass(datapoints[cut:])
     return datapoints[0:cut] + [actual_fakes]
 
-def draw_datapoints(svg, datapoints):
-    datagroup = ET.Element("g")
-    labelgroup = ET.Element("g")
+class Segment():
+    """
+    Laid out datapoint of a diagram, spanning radian_size radians from
+    radian_start, in the ring starting at radius_inner.
+    """
+    def __init__(self, datapoint, radian_start, radian_size, radius_inner, level, palette_index):
+        self.datapoint = datapoint
+        self.radian_start = radian_start
+        self.radian_size = radian_size
+        self.radius_inner = radius_inner
+        self.level = level
+        self.palette_index = palette_index
+        # nested segments, drawn outside of this one
+        self.children = []
+
+    @property
+    def radian_end(self):
+        return self.radian_start + self.radian_size
+
+    @property
+    def radius_outer(self):
+        return self.radius_inner + COUNTRY_SPEC_WIDTH
+
+def layout_datapoints(datapoints):
+    """
+    Compute the segments of a diagram without drawing anything.
+    Returns the top level segments.
+    """
     datapoints = bunch_datapoints(datapoints, COUNTRY_SPEC_INNER, 2 * pi)
+    # restart the palette for each diagram, so that its colors don't
+    # depend on which diagrams were drawn before it
+    palette = cycle(range(PALETTE_SIZE))
     total_size = sum(d.size for d in datapoints)
     rads_per_size = 2 * pi / total_size
 
-    total_ratio = FakeClass(datapoints).fraction_filled
+    def layout_section(radian_start, dp, palette_index, radius_inner, level):
+        radian_size = dp.size * rads_per_size
+        segment = Segment(dp, radian_start, radian_size, radius_inner, level, palette_index)
+
+        radius_children = segment.radius_outer + STROKES
+        children = bunch_datapoints(dp.children, radius_children, radian_size)
+        if len(children) <= 1:
+            return segment
+        radian_start_child = radian_start
+        for d_child, d_palette_index in zip(children, palette):
+            segment.children.append(
+                layout_section(radian_start_child, d_child, d_palette_index, radius_children, level + 1)
+            )
+            radian_start_child += d_child.size * rads_per_size
+        return segment
+
+    segments = []
+    # start with half a padding
+    radian_done = 0.0
+    for dp, palette_index in zip(datapoints, palette):
+        segments.append(layout_section(radian_done, dp, palette_index, COUNTRY_SPEC_INNER, 0))
+        radian_done += dp.size * rads_per_size
+    return segments
+
+def draw_datapoints(svg, datapoints, total_ratio, id_prefix=""):
+    datagroup = ET.Element("g")
+    labelgroup = ET.Element("g")
+
     total_radius = sqrt(total_ratio) * (COUNTRY_SPEC_INNER - STROKES)
     section_all = ET.Element("circle", attrib={
-        "fill": "#279ee3",
+        "class": "total",
         "r": f"{total_radius}",
     })
     datagroup.append(section_all)
 
-    radius_width = COUNTRY_SPEC_WIDTH
-    def make_section(radian_start, dp, fill_color, radius_inner):
-        radian_size = dp.size * rads_per_size
-        radian_end = radian_start + radian_size
+    def draw_section(segment):
+        dp = segment.datapoint
+        (radian_start, radian_end) = (segment.radian_start, segment.radian_end)
+        radian_size = segment.radian_size
+        (radius_inner, radius_outer) = (segment.radius_inner, segment.radius_outer)
+        level = segment.level
 
         d_ratio = dp.fraction_filled
         if d_ratio is None: # no data
-            outer_radius = radius_inner + radius_width
-            section_d = sector(radius_inner, outer_radius, radian_start, radian_end)
+            section_d = sector(radius_inner, radius_outer, radian_start, radian_end)
             section_d.attrib["fill"] = "url(#diagonalHatch)"
+            section_d.attrib["class"] = f"level-{level} no-data"
             datagroup.append(section_d)
         else:
             # don't use d_ratio directly, be correct about visual area
             # radius_ratio^2 = ratio * radius_outer^2 + (1-ratio) * radius_inner^2
-            radius_ratio = sqrt(d_ratio * (radius_inner + radius_width) ** 2 + (1 - d_ratio) * radius_inner ** 2)
+            radius_ratio = sqrt(d_ratio * radius_outer ** 2 + (1 - d_ratio) * radius_inner ** 2)
             section_d = sector(radius_inner, radius_ratio, radian_start, radian_end)
-            r, g, b = fill_color
-            section_d.attrib["fill"] = f"#{r:02x}{g:02x}{b:02x}"
+            # colors are defined by the theme, see Theme
+            section_d.attrib["class"] = f"level-{level} palette-{segment.palette_index}"
             datagroup.append(section_d)
 
-        outer_circle = circle_part(radius_inner + radius_width, radian_start, radian_end)
+        outer_circle = circle_part(radius_outer, radian_start, radian_end)
         svg.append(outer_circle)
 
         if radian_size * radius_inner > 4:
             small_label_size = int(radian_size * radius_inner)
             label_outside_in = radian_start + radian_size / 2 > pi
             overflow = COUNTRY_SPEC_INNER / 2
-            (label_r_start, label_r_end) = (radius_inner - overflow, radius_inner + radius_width + overflow)
+            (label_r_start, label_r_end) = (radius_inner - overflow, radius_outer + overflow)
             if label_outside_in:
                 (label_r_start, label_r_end) = (label_r_end, label_r_start)
             label_path = seperator(
                 label_r_start, label_r_end, radian_start + radian_size / 2
             )
-            label_id = f"textpath-{dp.hash}"
+            label_id = f"{id_prefix}textpath-{dp.hash}"
             label_path.attrib["id"] = label_id
             label_defs = ET.Element("defs")
             label_defs.append(label_path)
@@ -469,38 +693,26 @@ def draw_datapoints(svg, datapoints):
             labelgroup.append(label_defs)
             labelgroup.append(label_text)
 
-        radius_children = radius_inner + radius_width + STROKES
-        children = bunch_datapoints(dp.children, radius_children, radian_size)
-        if len(children) <= 1:
-            return False
-        radian_start_child = radian_start
-        for d_child, d_color in zip(children, PALETTE_XGFS_NORMAL12):
-            make_section(radian_start_child, d_child, d_color, radius_children)
-            radian_start_child += d_child.size * rads_per_size
-        return True
-    # start with half a padding
-    radian_done = 0.0
-    for dp, dcolor in zip(datapoints, PALETTE_XGFS_NORMAL12):
-        is_nested = make_section(radian_done, dp, dcolor, COUNTRY_SPEC_INNER)
-        sep_before = seperator(
-            COUNTRY_SPEC_INNER,
-            COUNTRY_SPEC_INNER + COUNTRY_SPEC_WIDTH,
-            radian_done
-        )
-        radian_done += dp.size * rads_per_size
-        sep_after = seperator(
-            COUNTRY_SPEC_INNER,
-            COUNTRY_SPEC_INNER + COUNTRY_SPEC_WIDTH,
-            radian_done
-        )
-        if is_nested:
-            svg.append(sep_before)
-            svg.append(sep_after)
+        for child in segment.children:
+            draw_section(child)
+
+    for segment in layout_datapoints(datapoints):
+        draw_section(segment)
+        if segment.children:
+            svg.append(seperator(
+                COUNTRY_SPEC_INNER,
+                COUNTRY_SPEC_INNER + COUNTRY_SPEC_WIDTH,
+                segment.radian_start
+            ))
+            svg.append(seperator(
+                COUNTRY_SPEC_INNER,
+                COUNTRY_SPEC_INNER + COUNTRY_SPEC_WIDTH,
+                segment.radian_end
+            ))
     svg.append(datagroup)
     svg.append(labelgroup)
 
 def get_date_of_data():
-    import subprocess
     git_date = subprocess.run(
         ["git", "log", "-1", "--format=%cd"],
         cwd="./covid-19-data/",
@@ -510,10 +722,13 @@ def get_date_of_data():
     return git_date.stdout.decode('utf-8').strip()
 
 class ModelFull():
-    def __init__(self, criteria_label, label_all, basename):
+    name = "full"
+
+    def __init__(self, criteria_label, label_all, basename, output_dir="results"):
         self.criteria_label = criteria_label
         self.label_all = label_all
-        self.filename = f"results/{basename}.svg"
+        self.diagram_id = f"{basename}"
+        self.filename = os.path.join(output_dir, f"{self.diagram_id}.svg")
 
     def legend(self, dimension):
         return ET.fromstring(Rf'''
@@ -537,10 +752,13 @@ class ModelFull():
         return get_date_of_data()
 
 class ModelPartial():
-    def __init__(self, criteria_label, label_all, basename):
+    name = "partial"
+
+    def __init__(self, criteria_label, label_all, basename, output_dir="results"):
         self.criteria_label = criteria_label
         self.label_all = label_all
-        self.filename = f"results/{basename}_partial.svg"
+        self.diagram_id = f"{basename}_partial"
+        self.filename = os.path.join(output_dir, f"{self.diagram_id}.svg")
 
     def legend(self, dimension):
         return ET.fromstring(Rf'''
@@ -563,10 +781,8 @@ class ModelPartial():
     def timestamp(self):
         return get_date_of_data()
 
-def draw_diagram(model, datapoints):
-    svg = ET.Element("svg", attrib={
-        "xmlns": "http://www.w3.org/2000/svg",
-    })
+def append_shared_defs(svg):
+    """style and definitions used by every diagram"""
     style = ET.fromstring(
 R'''
 <style>
@@ -625,7 +841,7 @@ R'''
     hatch_pattern = ET.fromstring(
 R"""
 <pattern id="diagonalHatch" width="10" height="10" patternTransform="rotate(45 0 0)" patternUnits="userSpaceOnUse">
-  <line x1="0" y1="0" x2="0" y2="10" style="stroke:#444; stroke-width:1" />
+  <line x1="0" y1="0" x2="0" y2="10" class="hatch" stroke-width="1" />
 </pattern>
 """
     )
@@ -633,16 +849,25 @@ R"""
     defs.append(hatch_pattern)
     svg.append(defs)
 
+def draw_diagram_content(svg, model, datapoints, totals=None, id_prefix=""):
+    """
+    Draw a diagram without the shared definitions.
+    Returns the view box (x, y, width, height) of the diagram.
+    """
+    if totals is None:
+        totals = GroupTotal(None, FakeClass(datapoints).fraction_filled)
+    global_perc = totals.fraction_filled
+
     inner_circle = ET.Element("circle", attrib={
         "cx": "0",
         "cy": "0",
         "r": f"{COUNTRY_SPEC_INNER - STROKES/2}",
-        "stroke": STROKE_COLOR,
+        "class": "outline",
         "stroke-width": f"{STROKES}",
         "fill": "none",
     })
     svg.append(inner_circle)
-    draw_datapoints(svg, datapoints)
+    draw_datapoints(svg, datapoints, global_perc, id_prefix)
 
     dimension = 2 * COUNTRY_SPEC_WIDTH + COUNTRY_SPEC_INNER + 2 * STROKES + 50
     dimdim = 2 * dimension
@@ -666,7 +891,6 @@ R"""
     ''')
     svg.append(sources)
 
-    global_perc = FakeClass(datapoints).fraction_filled
     center_text = ET.fromstring(Rf'''
 <text text-anchor="middle" dominant-baseline="middle" class="label_all" x="0" y="0">
     <tspan>{xmlescape(model.label_all)} | {100 * global_perc:.1f}%</tspan>
@@ -674,10 +898,197 @@ R"""
 ''')
     svg.append(center_text)
 
-    svg.attrib["viewBox"] = f"-{dimension + 10} -{dimension + 30} {dimdim + 20} {dimdim + 80}"
+    return (-(dimension + 10), -(dimension + 30), dimdim + 20, dimdim + 80)
+
+def write_themed(svg, filename, themes):
+    """Write the svg once per theme, only swapping the theme's style"""
+    theme_style = ET.Element("style")
+    svg.append(theme_style)
+    for theme in themes:
+        theme_style.text = theme.css()
+        with open(theme.filename(filename), "wb") as result_h:
+            result_h.write(ET.tostring(svg))
+
+def draw_diagram(model, datapoints, totals=None, themes=(THEMES[DEFAULT_THEME],)):
+    svg = ET.Element("svg", attrib={
+        "xmlns": "http://www.w3.org/2000/svg",
+    })
+    append_shared_defs(svg)
+    (x, y, width, height) = draw_diagram_content(svg, model, datapoints, totals)
+    svg.attrib["viewBox"] = f"{x} {y} {width} {height}"
+
+    write_themed(svg, model.filename, themes)
+
+def draw_atlas(filename, diagrams, columns, themes=(THEMES[DEFAULT_THEME],)):
+    """
+    Draw several diagrams into one svg, sharing the style and definitions.
+    Each diagram is a symbol, placed in a grid with the given columns.
+    A single diagram is shown by linking to {filename}#{model.diagram_id}.
 
-    with open(model.filename, "wb") as result_h:
-        result_h.write(ET.tostring(svg))
+    diagrams is a list of (model, datapoints, totals).
+    """
+    svg = ET.Element("svg", attrib={
+        "xmlns": "http://www.w3.org/2000/svg",
+    })
+    append_shared_defs(svg)
+    symbols = ET.Element("defs")
+    svg.append(symbols)
+
+    for i, (model, datapoints, totals) in enumerate(diagrams):
+        symbol_id = f"{model.diagram_id}-symbol"
+        symbol = ET.Element("symbol", attrib={"id": symbol_id})
+        (x, y, width, height) = draw_diagram_content(
+            symbol, model, datapoints, totals, id_prefix=f"{model.diagram_id}-"
+        )
+        symbol.attrib["viewBox"] = f"{x} {y} {width} {height}"
+        symbols.append(symbol)
+
+        cell_x = (i % columns) * width
+        cell_y = (i // columns) * height
+        svg.append(ET.Element("use", attrib={
+            "href": f"#{symbol_id}",
+            "x": f"{cell_x}",
+            "y": f"{cell_y}",
+            "width": f"{width}",
+            "height": f"{height}",
+        }))
+        svg.append(ET.Element("view", attrib={
+            "id": model.diagram_id,
+            "viewBox": f"{cell_x} {cell_y} {width} {height}",
+        }))
+
+    rows = -(-len(diagrams) // columns)
+    svg.attrib["viewBox"] = f"0 0 {columns * width} {rows * height}"
+
+    write_themed(svg, filename, themes)
+
+# decimals of radians and fractions in exported layouts
+LAYOUT_PRECISION = 6
+LAYOUT_MAGIC = b"VCVL"
+LAYOUT_VERSION = 1
+
+def round_or_none(value):
+    if value is None:
+        return None
+    return round(value, LAYOUT_PRECISION)
+
+def datapoint_layout(dp):
+    return {
+        "label": dp.label,
+        "id": dp.key,
+        "size": dp.size,
+        "fraction": round_or_none(dp.fraction_filled),
+    }
+
+def segment_layout(segment):
+    layout = datapoint_layout(segment.datapoint)
+    layout.update({
+        "start": round(segment.radian_start, LAYOUT_PRECISION),
+        "end": round(segment.radian_end, LAYOUT_PRECISION),
+        "radius": segment.radius_inner,
+        "level": segment.level,
+        "palette": segment.palette_index,
+    })
+    if isinstance(segment.datapoint, FakeClass):
+        layout["members"] = [datapoint_layout(s) for s in segment.datapoint.standins]
+    if segment.children:
+        layout["children"] = [segment_layout(c) for c in segment.children]
+    return layout
+
+def diagram_layout(model, datapoints, totals=None):
+    if totals is None:
+        totals = GroupTotal(None, FakeClass(datapoints).fraction_filled)
+    return {
+        "id": model.diagram_id,
+        "model": model.name,
+        "criteria_label": model.criteria_label,
+        "label_all": model.label_all,
+        "fraction": round_or_none(totals.fraction_filled),
+        "segments": [segment_layout(s) for s in layout_datapoints(datapoints)],
+    }
+
+def pack_layout(layout):
+    """
+    Pack an exported layout into a binary form. Numbers are little endian,
+    strings are stored once in a table and referenced by their u32 index.
+    Missing fractions are stored as NaN.
+
+        header:  "VCVL", u16 version, u32 string count,
+                 per string: u16 byte length, utf-8 bytes,
+                 u32 timestamp, u16 diagram count
+        diagram: u32 id, u32 model, u32 criteria_label, u32 label_all,
+                 f32 fraction, u16 segment count, segments
+        segment: u32 label, u32 id, u64 size, f32 fraction,
+                 f32 start, f32 end, f32 radius, u8 level, u8 palette,
+                 u16 member count, u16 child count, members, child segments
+        member:  u32 label, u32 id, u64 size, f32 fraction
+    """
+    strings = {}
+    def string(value):
+        return strings.setdefault(str(value), len(strings))
+    def fraction(value):
+        return float("nan") if value is None else value
+    def pack_datapoint(dp):
+        return struct.pack(
+            "<IIQf", string(dp["label"]), string(dp["id"]), dp["size"], fraction(dp["fraction"])
+        )
+    def pack_segment(segment):
+        members = segment.get("members", [])
+        children = segment.get("children", [])
+        return b"".join([
+            pack_datapoint(segment),
+            struct.pack(
+                "<fffBBHH", segment["start"], segment["end"], segment["radius"],
+                segment["level"], segment["palette"], len(members), len(children),
+            ),
+            *(pack_datapoint(m) for m in members),
+            *(pack_segment(c) for c in children),
+        ])
+
+    body = [struct.pack("<IH", string(layout["timestamp"]), len(layout["diagrams"]))]
+    for diagram in layout["diagrams"]:
+        body.append(struct.pack(
+            "<IIIIfH",
+            string(diagram["id"]), string(diagram["model"]),
+            string(diagram["criteria_label"]), string(diagram["label_all"]),
+            fraction(diagram["fraction"]), len(diagram["segments"]),
+        ))
+        body.extend(pack_segment(s) for s in diagram["segments"])
+
+    header = [LAYOUT_MAGIC, struct.pack("<HI", LAYOUT_VERSION, len(strings))]
+    for value in strings:
+        encoded = value.encode("utf-8")
+        header.append(struct.pack("<H", len(encoded)))
+        header.append(encoded)
+    return b"".join(header + body)
+
+def export_layout(filename, diagrams, packed=False):
+    """
+    Write the computed layout of the diagrams into one json file, without
+    drawing them. With packed, also write it in binary next to it, see
+    pack_layout.
+
+    diagrams is a list of (model, datapoints, totals).
+    """
+    layout = {
+        "timestamp": get_date_of_data(),
+        "geometry": {
+            "inner": COUNTRY_SPEC_INNER,
+            "width": COUNTRY_SPEC_WIDTH,
+            "spacing": SPACING_SIZE,
+            "strokes": STROKES,
+        },
+        "diagrams": [
+            diagram_layout(model, datapoints, totals)
+            for (model, datapoints, totals) in diagrams
+        ],
+    }
+    with open(filename, "w") as layout_h:
+        json.dump(layout, layout_h, separators=(",", ":"))
+    if packed:
+        (root, _) = os.path.splitext(filename)
+        with open(f"{root}.bin", "wb") as packed_h:
+            packed_h.write(pack_layout(layout))
 
 COUNTRIES_MIDDLE_EAST = (
       "EGY", "TUR", "IRN", "IRQ", "SAU"
@@ -689,32 +1100,84 @@ MIDDLE_EAST_CONT = {
     "": "Middle East"
 }
 
-def main():
-    with open("covid-19-data/public/data/vaccinations/vaccinations.json") as data_h:
+SUBMODULE = "covid-19-data"
+VACC_JSON = f"{SUBMODULE}/public/data/vaccinations/vaccinations.json"
+VACC_LOCATIONS_CSV = f"{SUBMODULE}/public/data/vaccinations/locations.csv"
+VACC_COUNTRY_DATA = f"{SUBMODULE}/public/data/vaccinations/country_data/"
+CDC_DATA_GLOB = f"{SUBMODULE}/scripts/input/cdc/vaccinations/cdc_data_*"
+CONTINENTS_CSV = f"{SUBMODULE}/scripts/input/owid/continents.csv"
+POPULATION_CSV = f"{SUBMODULE}/scripts/input/un/population_2020.csv"
+
+VACC_KEYS = ("total_vaccinations", "people_vaccinated", "people_fully_vaccinated")
+
+def latest_data_points(data):
+    """
+    Only keep the latest data point for each of the VACC_KEYS, all
+    that is used by the models.
+    """
+    latest = {}
+    for i, d in enumerate(data):
+        for k in VACC_KEYS:
+            if k in d:
+                latest[k] = i
+    return [
+        {k: v for k, v in data[i].items() if k == "date" or k in VACC_KEYS}
+        for i in sorted(set(latest.values()))
+    ]
+
+def read_vacc_data(path):
+    with open(path) as data_h:
         vacc_reader = json.load(data_h)
-        vacc_data = {
-            d["iso_code"]: d for d in vacc_reader
+        return {
+            d["iso_code"]: {
+                "country": d["country"],
+                "iso_code": d["iso_code"],
+                "data": latest_data_points(d["data"]),
+            } for d in vacc_reader
         }
 
-    latest_cdc_data = max(glob.glob("covid-19-data/scripts/input/cdc/vaccinations/cdc_data_*"))
-    print(f"Using cdc file {latest_cdc_data}")
-    with open(latest_cdc_data) as states_data_h:
+def read_vacc_location(path, iso_code):
+    """Read a per location file into the format of vaccinations.json"""
+    with open(path) as location_h:
+        location_reader = csv.DictReader(location_h)
+        data = [
+            {
+                "date": d["date"],
+                **{k: int(float(d[k])) for k in VACC_KEYS if d.get(k)},
+            } for d in location_reader
+        ]
+    return {
+        "country": os.path.splitext(os.path.basename(path))[0],
+        "iso_code": iso_code,
+        "data": latest_data_points(data),
+    }
+
+def read_vacc_locations(path):
+    with open(path) as locations_h:
+        return {
+            l["location"]: l["iso_code"] for l in csv.DictReader(locations_h)
+        }
+
+def read_vacc_usa_data(path):
+    with open(path) as states_data_h:
         vacc_usa_reader = csv.DictReader(states_data_h)
-        vacc_usa_data = {
+        return {
             d["LongName"]: d for d in vacc_usa_reader
             if d["Location"] not in ("US", "LTC", "VA2", "BP2", "DD2", "IH2")
         }
 
-    with open("covid-19-data/scripts/input/owid/continents.csv", "r") as continents_h:
+def read_country_to_continent(path):
+    with open(path, "r") as continents_h:
         region_reader = csv.DictReader(continents_h)
-        country_to_continent = {
+        return {
             c["Code"]: (c if c["Code"] not in COUNTRIES_MIDDLE_EAST else MIDDLE_EAST_CONT)
             for c in region_reader
         }
 
-    with open("covid-19-data/scripts/input/un/population_2020.csv", "r") as pop_h:
+def read_pop_data(path):
+    with open(path, "r") as pop_h:
         census_reader = csv.DictReader(pop_h)
-        pop_data = [
+        return [
             {
                 "country": c["entity"],
                 "iso_code": c["iso_code"],
@@ -723,72 +1186,446 @@ def main():
             # census includes regions, filter those
             if len(c["iso_code"]) == 3
         ]
-    # country list
-    countries = pop_data
-    # countries by continent
-    continents = defaultdict(list)
-    for ctry in countries:
-        region = country_to_continent[ctry["iso_code"]]
-        continents[region[""]].append(ctry)
-
-    os.makedirs("results", exist_ok=True)
-
-    for (Model, CountryDP, USStateDP) in [
-            (ModelFull, Country, USState),
-            (ModelPartial, CountryPartial, USStatePartial)
-        ]:
-        draw_diagram(Model("Country and Region", "Worldwide", "world"), [
-            Region(r, [
-                CountryDP(c, vacc_data.get(c["iso_code"], None))
-                for c in cs
-            ]) for r,cs in continents.items()
-        ])
 
-        draw_diagram(Model("Country", "Europe", "europe"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["Europe"]
-        ])
+def submodule_git(*args):
+    return subprocess.run(
+        ["git", *args],
+        cwd=f"./{SUBMODULE}/",
+        capture_output=True
+    )
 
-        north_america = [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["North America"]
-            if c["iso_code"] != "USA"
-        ]
-        north_america.append(Region("United States", [
-            USStateDP(sd) for sd in vacc_usa_data.values()
-        ]))
-        draw_diagram(Model("Country and US State", "North America", "north_america"),
-            north_america,
+def changed_files(since, until):
+    """
+    Paths changed in the submodule between two commits, or None if that
+    can not be determined, e.g. when the old commit was not fetched.
+    """
+    if since is None:
+        return None
+    if since == until:
+        return set()
+    diff = submodule_git("diff", "--name-only", "--no-renames", since, until)
+    if diff.returncode != 0:
+        return None
+    return {
+        f"{SUBMODULE}/{p}" for p in diff.stdout.decode("utf-8").splitlines()
+    }
+
+def code_version():
+    """hash of this file, stored inputs parsed by other code are discarded"""
+    with open(__file__, "rb") as code_h:
+        return hashlib.sha256(code_h.read()).hexdigest()
+
+class Ingestion():
+    """
+    Reads the inputs from the covid-19-data submodule.
+
+    With a state directory, each parsed input is stored in its own file,
+    vaccinations in one file per location, next to an index holding the
+    submodule commit each input was read at. A later run only re-reads the
+    inputs whose files changed since their commit, and re-reads vaccinations
+    per changed location. Stored inputs are only loaded when they are
+    requested, inputs not requested in a run are kept at their commit.
+    """
+    def __init__(self, state_dir=None):
+        self._state_dir = state_dir
+        self._index = {"version": code_version(), "inputs": {}}
+        if state_dir is not None:
+            index = self._load("index")
+            if index is not None and index.get("version") == self._index["version"]:
+                self._index = index
+        commit = submodule_git("rev-parse", "HEAD")
+        self._commit = commit.stdout.decode("utf-8").strip() if commit.returncode == 0 else None
+        # changed files since a commit, by commit
+        self._changes = {}
+        # whether the index has to be saved
+        self._dirty = False
+
+    def _load(self, name):
+        path = os.path.join(self._state_dir, f"{name}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as stored_h:
+            return json.load(stored_h)
+
+    def _store(self, name, data):
+        if self._state_dir is None:
+            return
+        path = os.path.join(self._state_dir, f"{name}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as stored_h:
+            json.dump(data, stored_h)
+
+    def _changed_since(self, name):
+        """files changed since the commit the input was stored at"""
+        stored = self._index["inputs"].get(name)
+        if stored is None:
+            return None
+        since = stored["commit"]
+        if since not in self._changes:
+            self._changes[since] = changed_files(since, self._commit)
+        return self._changes[since]
+
+    def _reusable(self, name, path):
+        stored = self._index["inputs"].get(name)
+        changed = self._changed_since(name)
+        return (
+            stored is not None
+            and stored["path"] == path
+            and changed is not None
+            and path not in changed
         )
 
-        draw_diagram(Model("State", "United States", "usa"), [
-            USStateDP(sd) for sd in vacc_usa_data.values()
-        ])
+    def _mark_read(self, name, path):
+        """the stored input is up to date at the current commit"""
+        stored = {"path": path, "commit": self._commit}
+        if self._index["inputs"].get(name) != stored:
+            self._index["inputs"][name] = stored
+            self._dirty = True
+
+    def _read(self, name, path, reader):
+        if self._reusable(name, path):
+            data = self._load(name)
+            if data is not None:
+                self._mark_read(name, path)
+                return data
+        data = reader(path)
+        self._store(name, data)
+        self._mark_read(name, path)
+        return data
+
+    def _load_vacc_data(self):
+        location_dir = os.path.join(self._state_dir, "vaccinations")
+        return {
+            iso_code: self._load(f"vaccinations/{iso_code}")
+            for iso_code in (os.path.splitext(f)[0] for f in os.listdir(location_dir))
+        }
 
-        draw_diagram(Model("Country", "Africa", "africa"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["Africa"]
-        ])
+    def _store_vacc_location(self, iso_code, record):
+        if record is None:
+            if self._state_dir is not None:
+                os.remove(os.path.join(self._state_dir, "vaccinations", f"{iso_code}.json"))
+            return
+        self._store(f"vaccinations/{iso_code}", record)
+
+    def vacc_data(self):
+        changed_locations = sorted(
+            p for p in (self._changed_since("vaccinations") or ())
+            if p.startswith(VACC_COUNTRY_DATA) and p.endswith(".csv")
+        )
+        stored = self._index["inputs"].get("vaccinations")
+        if stored is not None and self._reusable("vaccinations", VACC_JSON):
+            self._mark_read("vaccinations", VACC_JSON)
+            return self._load_vacc_data()
+
+        # vaccinations.json is regenerated from the per location files, so
+        # if those didn't change, something else did and we re-read it whole
+        if stored is None or not changed_locations:
+            vacc_data = read_vacc_data(VACC_JSON)
+            if self._state_dir is not None:
+                shutil.rmtree(os.path.join(self._state_dir, "vaccinations"), ignore_errors=True)
+            for iso_code, record in vacc_data.items():
+                self._store_vacc_location(iso_code, record)
+            self._mark_read("vaccinations", VACC_JSON)
+            return vacc_data
+
+        location_codes = read_vacc_locations(VACC_LOCATIONS_CSV)
+        vacc_data = self._load_vacc_data()
+        for path in changed_locations:
+            location = os.path.splitext(os.path.basename(path))[0]
+            iso_code = location_codes.get(location)
+            if iso_code is None:
+                # removed locations are in neither file anymore
+                for code, d in list(vacc_data.items()):
+                    if d["country"] == location:
+                        del vacc_data[code]
+                        self._store_vacc_location(code, None)
+                continue
+            if os.path.exists(path):
+                vacc_data[iso_code] = read_vacc_location(path, iso_code)
+                self._store_vacc_location(iso_code, vacc_data[iso_code])
+            elif vacc_data.pop(iso_code, None) is not None:
+                self._store_vacc_location(iso_code, None)
+        self._mark_read("vaccinations", VACC_JSON)
+        print(f"Re-read {len(changed_locations)} changed vaccination locations")
+        return vacc_data
+
+    def vacc_usa_data(self):
+        latest_cdc_data = max(glob.glob(CDC_DATA_GLOB))
+        print(f"Using cdc file {latest_cdc_data}")
+        return self._read("cdc", latest_cdc_data, read_vacc_usa_data)
+
+    def country_to_continent(self):
+        return self._read("continents", CONTINENTS_CSV, read_country_to_continent)
+
+    def pop_data(self):
+        return self._read("population", POPULATION_CSV, read_pop_data)
+
+    def save(self):
+        if self._state_dir is None:
+            return
+        if not self._dirty:
+            return
+        self._store("index", self._index)
+
+MODELS = [
+    (ModelFull, Country, USState),
+    (ModelPartial, CountryPartial, USStatePartial),
+]
+
+class Inputs():
+    """
+    Inputs needed by the diagrams, each is only read when first used.
+    """
+    def __init__(self, ingestion):
+        self._ingestion = ingestion
+
+    @cached_property
+    def vacc_data(self):
+        return self._ingestion.vacc_data()
+
+    @cached_property
+    def vacc_usa_data(self):
+        return self._ingestion.vacc_usa_data()
+
+    @cached_property
+    def continents(self):
+        country_to_continent = self._ingestion.country_to_continent()
+        # countries by continent
+        continents = defaultdict(list)
+        for ctry in self._ingestion.pop_data():
+            region = country_to_continent[ctry["iso_code"]]
+            continents[region[""]].append(ctry)
+        return continents
+
+# A country or US state, independent of the model
+Leaf = namedtuple("Leaf", ["kind", "data"])
+# A region of leaves, drawn with the leaves nested outside of it
+Group = namedtuple("Group", ["label", "leaves"])
+
+def leaf_datapoint(leaf, model_index, inputs):
+    (_, CountryDP, USStateDP) = MODELS[model_index]
+    if leaf.kind == "country":
+        return CountryDP(leaf.data, inputs.vacc_data.get(leaf.data["iso_code"], None))
+    return USStateDP(leaf.data)
+
+def countries_of(continent, exclude=()):
+    def entries(inputs):
+        return [
+            Leaf("country", c) for c in inputs.continents[continent]
+            if c["iso_code"] not in exclude
+        ]
+    return entries
 
-        draw_diagram(Model("Country", "Asia", "asia"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["Asia"]
-        ])
+def us_states(inputs):
+    return [Leaf("state", sd) for sd in inputs.vacc_usa_data.values()]
 
-        draw_diagram(Model("Country", "South America", "south_america"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["South America"]
-        ])
+def world_entries(inputs):
+    return [
+        Group(r, [Leaf("country", c) for c in cs])
+        for r, cs in inputs.continents.items()
+    ]
 
-        draw_diagram(Model("Country", "Oceania", "oce"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["Oceania"]
-        ])
+def north_america_entries(inputs):
+    north_america = countries_of("North America", exclude=("USA",))(inputs)
+    north_america.append(Group("United States", us_states(inputs)))
+    return north_america
 
-        draw_diagram(Model("Country", "Middle East", "middle_east"), [
-            CountryDP(c, vacc_data.get(c["iso_code"], None))
-            for c in continents["Middle East"]
-        ])
+class Diagram():
+    def __init__(self, basename, criteria_label, label_all, entries):
+        self.basename = basename
+        self.criteria_label = criteria_label
+        self.label_all = label_all
+        # function of the Inputs, returning a list of Leaf and Group
+        self.entries = entries
+
+DIAGRAMS = [
+    Diagram("world", "Country and Region", "Worldwide", world_entries),
+    Diagram("europe", "Country", "Europe", countries_of("Europe")),
+    Diagram("north_america", "Country and US State", "North America", north_america_entries),
+    Diagram("usa", "State", "United States", us_states),
+    Diagram("africa", "Country", "Africa", countries_of("Africa")),
+    Diagram("asia", "Country", "Asia", countries_of("Asia")),
+    Diagram("south_america", "Country", "South America", countries_of("South America")),
+    Diagram("oce", "Country", "Oceania", countries_of("Oceania")),
+    Diagram("middle_east", "Country", "Middle East", countries_of("Middle East")),
+]
+
+def entry_datapoints(entries, model_index, inputs):
+    """the entries of a diagram, with each Leaf replaced by its datapoint"""
+    return [
+        Group(entry.label, [leaf_datapoint(leaf, model_index, inputs) for leaf in entry.leaves])
+        if isinstance(entry, Group) else leaf_datapoint(entry, model_index, inputs)
+        for entry in entries
+    ]
+
+def aggregate_totals(diagram_datapoints):
+    """
+    Totals of all regions and of all diagrams, for every model.
+    diagram_datapoints holds the entry_datapoints of each model by diagram
+    basename. Regions are labeled by (diagram basename, region label),
+    diagrams by their basename.
+    """
+    # leaf datapoints of every model, in the same order
+    leaves = [[] for _ in MODELS]
+    region_grouping = Grouping()
+    # members of the diagrams, regions are offset by the leaf count later
+    diagram_members = []
+    for basename, model_entries in diagram_datapoints.items():
+        for model_entry in zip(*model_entries):
+            entry = model_entry[0]
+            if isinstance(entry, Group):
+                for row in range(len(leaves[0]), len(leaves[0]) + len(entry.leaves)):
+                    region_grouping.add((basename, entry.label), row)
+                for m, e in enumerate(model_entry):
+                    leaves[m].extend(e.leaves)
+                diagram_members.append((basename, None, (basename, entry.label)))
+            else:
+                diagram_members.append((basename, len(leaves[0]), None))
+                for m, e in enumerate(model_entry):
+                    leaves[m].append(e)
+
+    leaf_rows = Aggregation(
+        [dp.size for dp in leaves[0]],
+        [[dp.model_count for dp in dps] for dps in leaves],
+    )
+    regions = leaf_rows.reduce(region_grouping)
+
+    diagram_grouping = Grouping()
+    for basename, row, region in diagram_members:
+        if region is not None:
+            # regions are appended after the leaves
+            row = len(leaf_rows) + region_grouping.labels[region]
+        diagram_grouping.add(basename, row)
+    diagrams = leaf_rows.concat(regions).reduce(diagram_grouping)
+
+    return regions, diagrams
+
+def build_diagrams(diagrams, models, inputs, output_dir="results"):
+    """
+    Yield (model, datapoints, totals) of the selected diagrams,
+    ordered by region and then by model.
+    """
+    # the leaf datapoints are shared by the aggregation and the diagrams
+    diagram_datapoints = {}
+    for d in diagrams:
+        entries = d.entries(inputs)
+        diagram_datapoints[d.basename] = [
+            entry_datapoints(entries, m, inputs) for m in range(len(MODELS))
+        ]
+    region_totals, diagram_totals = aggregate_totals(diagram_datapoints)
+
+    for diagram in diagrams:
+        for m, (Model, _, _) in enumerate(MODELS):
+            if Model.name not in models:
+                continue
+            datapoints = [
+                Region(entry.label, entry.leaves, region_totals.total(m, (diagram.basename, entry.label)))
+                if isinstance(entry, Group) else entry
+                for entry in diagram_datapoints[diagram.basename][m]
+            ]
+            model = Model(diagram.criteria_label, diagram.label_all, diagram.basename, output_dir)
+            yield (model, datapoints, diagram_totals.total(m, diagram.basename))
+
+def render(diagrams, models, inputs, output_dir, atlas=False, themes=(THEMES[DEFAULT_THEME],), layout=False):
+    os.makedirs(output_dir, exist_ok=True)
+
+    built = list(build_diagrams(diagrams, models, inputs, output_dir))
+    for (model, datapoints, totals) in built:
+        draw_diagram(model, datapoints, totals, themes)
+    if atlas:
+        filename = os.path.join(output_dir, "atlas.svg")
+        # one row per region, one column per model
+        draw_atlas(filename, built, len(models), themes)
+    if layout:
+        export_layout(os.path.join(output_dir, "layout.json"), built, packed=True)
+
+def export(diagrams, models, inputs, filename, packed=False):
+    output_dir = os.path.dirname(filename)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    export_layout(filename, list(build_diagrams(diagrams, models, inputs)), packed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--state", metavar="DIR",
+        help="remember the processed submodule commit and inputs in DIR, "
+             "and only re-read inputs that changed since",
+    )
+    # filters shared by the subcommands
+    filter_parser = argparse.ArgumentParser(add_help=False)
+    filter_parser.add_argument(
+        "--region", action="append", choices=[d.basename for d in DIAGRAMS],
+        help="only use the diagram of this region, can be repeated",
+    )
+    filter_parser.add_argument(
+        "--model", action="append", choices=[Model.name for (Model, _, _) in MODELS],
+        help="only use this model, can be repeated",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    render_parser = subparsers.add_parser(
+        "render", parents=[filter_parser],
+        help="draw the diagrams (default, draws all of them)",
+    )
+    render_parser.add_argument(
+        "--output-dir", default="results",
+        help="directory to write the diagrams to (default: %(default)s)",
+    )
+    render_parser.add_argument(
+        "--atlas", action="store_true",
+        help="also draw the diagrams into a single atlas.svg with shared definitions, "
+             "link to atlas.svg#<diagram> to show one of them",
+    )
+    render_parser.add_argument(
+        "--theme", action="append", choices=list(THEMES),
+        help="write the diagrams in this theme, can be repeated. Themes other than "
+             "the default are written to <diagram>_<theme>.svg (default: default)",
+    )
+    render_parser.add_argument(
+        "--layout", action="store_true",
+        help="also write the layout of the diagrams to layout.json and layout.bin, see export",
+    )
+    export_parser = subparsers.add_parser(
+        "export", parents=[filter_parser],
+        help="write the layout of the diagrams as json, for drawing them client side",
+    )
+    export_parser.add_argument(
+        "--output", default="results/layout.json",
+        help="file to write the layout to (default: %(default)s)",
+    )
+    export_parser.add_argument(
+        "--packed", action="store_true",
+        help="also write the layout in a packed binary form, next to the json with a .bin suffix",
+    )
+    subparsers.add_parser("list", help="list the regions that can be drawn")
+
+    argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(argv + ["render"])
+
+    if args.command == "list":
+        for diagram in DIAGRAMS:
+            print(f"{diagram.basename}: {diagram.label_all}")
+        return
+
+    diagrams = [
+        d for d in DIAGRAMS
+        if args.region is None or d.basename in args.region
+    ]
+    models = sorted(
+        set(args.model or [Model.name for (Model, _, _) in MODELS]),
+        key=[Model.name for (Model, _, _) in MODELS].index,
+    )
+
+    ingestion = Ingestion(args.state)
+    inputs = Inputs(ingestion)
+    if args.command == "export":
+        export(diagrams, models, inputs, args.output, args.packed)
+    else:
+        themes = [THEMES[t] for t in dict.fromkeys(args.theme or [DEFAULT_THEME])]
+        render(diagrams, models, inputs, args.output_dir, args.atlas, themes, args.layout)
+    ingestion.save()
 
 if __name__ == "__main__":
     main()